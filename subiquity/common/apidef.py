@@ -272,7 +272,8 @@ class API:
                 def GET() -> StorageResponseV2: ...
 
             class guided:
-                def GET(wait: bool = False) -> GuidedStorageResponseV2: ...
+                def GET(wait: bool = False, limit: Optional[int] = None) \
+                    -> GuidedStorageResponseV2: ...
                 def POST(data: Payload[GuidedChoiceV2]) \
                     -> GuidedStorageResponseV2: ...
 
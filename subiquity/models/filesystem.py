@@ -1069,6 +1069,7 @@ class FilesystemModel(object):
 
     def reset(self):
         self._all_ids = set()
+        self._by_id = {}
         if self._probe_data is not None:
             self._orig_config = storage_config.extract_storage_config(
                 self._probe_data)["storage"]["config"]
@@ -1096,6 +1097,7 @@ class FilesystemModel(object):
     def load_server_data(self, status):
         log.debug('load_server_data %s', status)
         self._all_ids = set()
+        self._by_id = {}
         self.storage_version = status.storage_version
         self._orig_config = status.orig_config
         self._probe_data = {
@@ -1186,8 +1188,8 @@ class FilesystemModel(object):
                 disks.remove(disk)
                 action['path'] = disk.path
                 action['serial'] = disk.serial
-        self._actions = self._actions_from_config(
-            ai_config, self._probe_data['blockdev'], is_probe_data=False)
+        self.set_actions(self._actions_from_config(
+            ai_config, self._probe_data['blockdev'], is_probe_data=False))
         for p in self._all(type="partition") + self._all(type="lvm_partition"):
             # NOTE For logical partitions (DOS), the parent is set to the disk,
             # not the extended partition.
@@ -1430,11 +1432,31 @@ class FilesystemModel(object):
                 yield a
 
     def _one(self, **kw):
+        if kw.keys() == {'id'}:
+            return self._one_by_id(kw['id'])
         try:
             return next(self._matcher(kw))
         except StopIteration:
             return None
 
+    def set_actions(self, actions):
+        self._actions = actions
+        self._by_id = {}
+
+    def _one_by_id(self, id):
+        # Lookups by id are common (the server API refers to everything
+        # by id) so remember the answers.  Misses are not cached as the
+        # action may be added later.  Anything that replaces _actions
+        # wholesale must reset _by_id (see set_actions).
+        try:
+            return self._by_id[id]
+        except KeyError:
+            pass
+        obj = next(self._matcher({'id': id}), None)
+        if obj is not None:
+            self._by_id[id] = obj
+        return obj
+
     def _all(self, **kw):
         return list(self._matcher(kw))
 
@@ -1470,6 +1492,7 @@ class FilesystemModel(object):
     def _remove(self, obj):
         _remove_backlinks(obj)
         self._actions.remove(obj)
+        self._by_id.pop(obj.id, None)
 
     def add_partition(self, device, *, size, offset, flag="", wipe=None,
                       grub_device=None):
@@ -307,6 +307,18 @@ class TestFilesystemModel(unittest.TestCase):
         self.assertFalse(lv.ok_for_raid)
         self.assertFalse(lv.ok_for_lvm_vg)
 
+    def test_one_by_id(self):
+        model, disk = make_model_and_disk()
+        self.assertIs(disk, model._one(id=disk.id))
+        self.assertIs(disk, model._one(id=disk.id))
+        self.assertIsNone(model._one(id='nonexistent'))
+        part = model.add_partition(disk, size=1 << 30, offset=1 << 20)
+        self.assertIs(part, model._one(id=part.id))
+        model.remove_partition(part)
+        self.assertIsNone(model._one(id=part.id))
+        model.set_actions([])
+        self.assertIsNone(model._one(id=disk.id))
+
 
 def fake_up_blockdata_disk(disk, **kw):
     model = disk._m
@@ -15,13 +15,12 @@
 
 import asyncio
 import functools
-import glob
+import heapq
 import json
 import logging
 import os
 import platform
-import select
-from typing import List
+from typing import List, Optional
 
 import pyudev
 
@@ -32,9 +31,6 @@ from subiquitycore.async_helpers import (
     TaskAlreadyRunningError,
     )
 from subiquitycore.context import with_context
-from subiquitycore.utils import (
-    run_command,
-    )
 from subiquitycore.lsb_release import lsb_release
 
 from subiquity.common.apidef import API
@@ -84,6 +80,26 @@ from subiquity.server.controller import (
 log = logging.getLogger("subiquity.server.controllers.filesystem")
 block_discover_log = logging.getLogger('block-discover')
 
+AHCI_DRIVER_DIR = '/sys/module/ahci/drivers/pci:ahci'
+
+
+@functools.lru_cache(maxsize=2)
+def _release(dry_run):
+    # The release cannot change while we are running.
+    return lsb_release(dry_run=dry_run)['release']
+
+
+def _bumps_gen(meth):
+    # Wrap a method that changes the model so that responses cached
+    # against the previous model generation are invalidated.
+    @functools.wraps(meth)
+    def wrapper(self, *args, **kw):
+        try:
+            return meth(self, *args, **kw)
+        finally:
+            self._bump_gen()
+    return wrapper
+
 
 class FilesystemController(SubiquityController, FilesystemManipulator):
 
@@ -104,12 +120,65 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
             self.model.bootloader = getattr(Bootloader, name)
         self.model.storage_version = self.opts.storage_version
         self._monitor = None
+        self._block_log_dir_fd = None
         self._errors = {}
         self._probe_once_task = SingleInstanceTask(
             self._probe_once, propagate_errors=False)
         self._probe_task = SingleInstanceTask(
             self._probe, propagate_errors=False, cancel_restart=False)
         self.supports_resilient_boot = False
+        # Rendering the model for the client is relatively expensive and the
+        # client polls, so renderings (and other values derived from the
+        # model) are cached until the model changes.
+        self._gen = 0
+        self._render_cache = {}
+        # Once a client has asked for the curtin-style config, re-render it
+        # whenever the model changes rather than when the next GET arrives.
+        self._prerender_config = False
+        self._prerender_handle = None
+
+    def _bump_gen(self):
+        self._gen += 1
+        self._render_cache.clear()
+        if self._prerender_config and self._prerender_handle is None:
+            # Mutations come in bursts from a single handler, so wait for the
+            # handler to return control to the loop and render once.
+            loop = asyncio.get_event_loop()
+            self._prerender_handle = loop.call_soon(self._prerender)
+
+    def _prerender(self):
+        self._prerender_handle = None
+        try:
+            self._rendered_config()
+        except Exception:
+            # Leave it to the GET that needs the config to report this.
+            log.exception("prerendering storage config failed")
+
+    def _rendered_config(self):
+        self._prerender_config = True
+        return self._cached('config', self.model._render_actions, True)
+
+    def _cached(self, key, func, *args):
+        try:
+            return self._render_cache[key]
+        except KeyError:
+            result = self._render_cache[key] = func(*args)
+            return result
+
+    def _supported_actions(self, device):
+        return self._cached(
+            ('supported', device.id),
+            lambda: frozenset(DeviceAction.supported(device)))
+
+    create_partition = _bumps_gen(FilesystemManipulator.create_partition)
+    delete_partition = _bumps_gen(FilesystemManipulator.delete_partition)
+    reformat = _bumps_gen(FilesystemManipulator.reformat)
+    partition_disk_handler = _bumps_gen(
+        FilesystemManipulator.partition_disk_handler)
+    add_boot_disk = _bumps_gen(FilesystemManipulator.add_boot_disk)
+    create_volgroup = _bumps_gen(FilesystemManipulator.create_volgroup)
+    create_logical_volume = _bumps_gen(
+        FilesystemManipulator.create_logical_volume)
 
     def load_autoinstall_data(self, data):
         log.debug("load_autoinstall_data %s", data)
@@ -147,22 +216,23 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
                 "partition")
 
     def guided_direct(self, gap):
-        spec = dict(fstype="ext4", mount="/")
+        spec = {"fstype": "ext4", "mount": "/"}
         self.create_partition(device=gap.device, gap=gap, spec=spec)
 
     def guided_lvm(self, gap, lvm_options=None):
         gap_boot, gap_rest = gap.split(sizes.get_bootfs_size(gap.size))
-        spec = dict(fstype="ext4", mount='/boot')
+        spec = {"fstype": "ext4", "mount": '/boot'}
         device = gap.device
         self.create_partition(device, gap_boot, spec)
-        part = self.create_partition(device, gap_rest, dict(fstype=None))
+        part = self.create_partition(device, gap_rest, {"fstype": None})
 
+        existing_names = {vg.name for vg in self.model.all_volgroups()}
         vg_name = 'ubuntu-vg'
         i = 0
-        while self.model._one(type='lvm_volgroup', name=vg_name) is not None:
+        while vg_name in existing_names:
             i += 1
             vg_name = 'ubuntu-vg-{}'.format(i)
-        spec = dict(name=vg_name, devices=set([part]))
+        spec = {"name": vg_name, "devices": {part}}
         if lvm_options and lvm_options['encrypt']:
             spec['password'] = lvm_options['luks_options']['password']
         vg = self.create_volgroup(spec)
@@ -184,12 +254,12 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
             lv_size = 100 * (1 << 30)
         lv_size = align_down(lv_size, LVM_CHUNK_SIZE)
         self.create_logical_volume(
-            vg=vg, spec=dict(
-                size=lv_size,
-                name="ubuntu-lv",
-                fstype="ext4",
-                mount="/",
-                ))
+            vg=vg, spec={
+                "size": lv_size,
+                "name": "ubuntu-lv",
+                "fstype": "ext4",
+                "mount": "/",
+                })
 
     @functools.singledispatchmethod
     def start_guided(self, target: GuidedStorageTarget,
@@ -223,6 +293,7 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
             raise Exception(f'Aligned requested size {new_size} too large')
         partition.size = new_size
         partition.resize = True
+        self._bump_gen()
         # Calculating where that gap will be can be tricky due to alignment
         # needs and the possibility that we may be splitting a logical
         # partition, which needs an extra 1MiB spacer.
@@ -248,7 +319,7 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
 
         disk = self.model._one(id=choice.target.disk_id)
         gap = self.start_guided(choice.target, disk)
-        if DeviceAction.TOGGLE_BOOT in DeviceAction.supported(disk):
+        if DeviceAction.TOGGLE_BOOT in self._supported_actions(disk):
             self.add_boot_disk(disk)
         # find what's left of the gap after adding boot
         gap = gap.within()
@@ -286,7 +357,7 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
             bootloader=self.model.bootloader,
             error_report=self.full_probe_error(),
             orig_config=self.model._orig_config,
-            config=self.model._render_actions(include_all=True),
+            config=list(self._rendered_config()),
             blockdev=self.model._probe_data['blockdev'],
             dasd=self.model._probe_data.get('dasd', {}),
             storage_version=self.model.storage_version)
@@ -299,11 +370,17 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
 
     async def POST(self, config: list):
         log.debug(config)
-        self.model._actions = self.model._actions_from_config(
-            config, self.model._probe_data['blockdev'], is_probe_data=False)
+        self.model.set_actions(self.model._actions_from_config(
+            config, self.model._probe_data['blockdev'], is_probe_data=False))
+        self._bump_gen()
         await self.configured()
 
     def get_guided_disks(self, check_boot=True, with_reformatting=False):
+        key = ('guided_disks', check_boot, with_reformatting)
+        return list(self._cached(
+            key, self._compute_guided_disks, check_boot, with_reformatting))
+
+    def _compute_guided_disks(self, check_boot, with_reformatting):
         disks = []
         for raid in self.model._all(type='raid'):
             if check_boot and not boot.can_be_boot_device(
@@ -315,13 +392,11 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
                     disk, with_reformatting=with_reformatting):
                 continue
             cd = disk.constructed_device()
-            if isinstance(cd, Raid):
-                can_be_boot = False
-                for v in cd._subvolumes:
-                    if check_boot and boot.can_be_boot_device(
-                            v, with_reformatting=with_reformatting):
-                        can_be_boot = True
-                if can_be_boot:
+            if check_boot and isinstance(cd, Raid):
+                # The bootable volume in the container is offered instead.
+                if any(boot.can_be_boot_device(
+                        v, with_reformatting=with_reformatting)
+                        for v in cd._subvolumes):
                     continue
             disks.append(disk)
         return disks
@@ -335,11 +410,16 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         # source catalog should directly specify the minimum suitable
         # size?)
         min_size = 2*self.app.base_model.source.current.size + (1 << 30)
-        disks = self.get_guided_disks(with_reformatting=True)
+        disks = self._cached(
+            ('guided', min_size), self._guided_disks_for_client, min_size)
         return GuidedStorageResponse(
             status=ProbeStatus.DONE,
             error_report=self.full_probe_error(),
-            disks=[labels.for_client(d, min_size=min_size) for d in disks])
+            disks=list(disks))
+
+    def _guided_disks_for_client(self, min_size):
+        disks = self.get_guided_disks(with_reformatting=True)
+        return [labels.for_client(d, min_size=min_size) for d in disks]
 
     async def guided_POST(self, data: GuidedChoice) -> StorageResponse:
         log.debug(data)
@@ -349,18 +429,52 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
     async def reset_POST(self, context, request) -> StorageResponse:
         log.info("Resetting Filesystem model")
         self.model.reset()
+        self._bump_gen()
         return await self.GET(context)
 
+    def _has_rst(self) -> bool:
+        # Only the device links under the driver directory have a
+        # remapped_nvme attribute, so just try each entry rather than
+        # globbing (which would stat every candidate first).
+        try:
+            with os.scandir(AHCI_DRIVER_DIR) as entries:
+                paths = [os.path.join(e.path, 'remapped_nvme')
+                         for e in entries]
+        except FileNotFoundError:
+            return False
+        for remapped_nvme in paths:
+            try:
+                with open(remapped_nvme, 'r') as f:
+                    if int(f.read()) > 0:
+                        return True
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return False
+
     async def has_rst_GET(self) -> bool:
-        search = '/sys/module/ahci/drivers/pci:ahci/*/remapped_nvme'
-        for remapped_nvme in glob.glob(search):
-            with open(remapped_nvme, 'r') as f:
-                if int(f.read()) > 0:
-                    return True
+        # Reading sysfs can block, so keep it off the event loop.
+        return await run_in_thread(self._has_rst)
+
+    def _probe_data_has_bitlocker(self):
+        # None means we can't tell from the probe data and have to look
+        # at the model.
+        probe_data = self.model._probe_data
+        if not probe_data:
+            return None
+        for data in probe_data.get('filesystem', {}).values():
+            if data.get('TYPE') == 'BitLocker':
+                return True
+        for data in probe_data.get('blockdev', {}).values():
+            if data.get('ID_FS_TYPE') == 'BitLocker':
+                return True
         return False
 
     async def has_bitlocker_GET(self) -> List[Disk]:
         '''list of Disks that contain a partition that is BitLockered'''
+        if self._probe_data_has_bitlocker() is False:
+            # Nothing to do with BitLocker was probed, so skip walking
+            # every partition of every disk.
+            return []
         bitlockered_disks = []
         for disk in self.model.all_disks():
             for part in disk.partitions():
@@ -373,11 +487,16 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
                     break
         return [labels.for_client(disk) for disk in bitlockered_disks]
 
+    def _partitions_by_number(self, disk):
+        return {p.number: p for p in disk.partitions()}
+
     def get_partition(self, disk, number):
-        for p in disk.partitions():
-            if p.number == number:
-                return p
-        raise ValueError(f'Partition {number} on {disk.id} not found')
+        partitions = self._cached(
+            ('partitions', disk.id), self._partitions_by_number, disk)
+        try:
+            return partitions[number]
+        except KeyError:
+            raise ValueError(f'Partition {number} on {disk.id} not found')
 
     def calculate_suggested_install_min(self):
         source_min = self.app.base_model.source.current.size
@@ -389,16 +508,22 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         probe_resp = await self._probe_response(wait, StorageResponseV2)
         if probe_resp is not None:
             return probe_resp
-        disks = model._all(type='disk')
+        if model is self.model:
+            disks = list(self._cached('disks', self._disks_for_client, model))
+        else:
+            disks = self._disks_for_client(model)
         minsize = self.calculate_suggested_install_min()
         return StorageResponseV2(
                 status=ProbeStatus.DONE,
-                disks=[labels.for_client(d) for d in disks],
+                disks=disks,
                 need_root=not model.is_root_mounted(),
                 need_boot=model.needs_bootloader_partition(),
                 install_minimum_size=minsize,
                 )
 
+    def _disks_for_client(self, model):
+        return [labels.for_client(d) for d in model._all(type='disk')]
+
     async def v2_GET(self, wait: bool = False) -> StorageResponseV2:
         return await self.get_v2_storage_response(self.model, wait)
 
@@ -413,13 +538,16 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
     async def v2_reset_POST(self) -> StorageResponseV2:
         log.info("Resetting Filesystem model")
         self.model.reset()
+        self._bump_gen()
         return await self.v2_GET()
 
-    async def v2_guided_GET(self, wait: bool = False) \
+    async def v2_guided_GET(self, wait: bool = False,
+                            limit: Optional[int] = None) \
             -> GuidedStorageResponseV2:
         """Acquire a list of possible guided storage configuration scenarios.
         Results are sorted by the size of the space potentially available to
-        the install."""
+        the install.  If limit is supplied, at most that many scenarios are
+        returned."""
         probe_resp = await self._probe_response(wait, GuidedStorageResponseV2)
         if probe_resp is not None:
             return probe_resp
@@ -446,6 +574,9 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
                 scenarios.append((gap.size, use_gap))
 
         for disk in self.get_guided_disks(check_boot=False):
+            if disk.size < install_min:
+                # No partition on this disk can be resized to make room.
+                continue
             part_align = disk.alignment_data().part_align
             for partition in disk.partitions():
                 vals = sizes.calculate_guided_resize(
@@ -461,7 +592,10 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
                         partition, vals)
                 scenarios.append((vals.install_max, resize))
 
-        scenarios.sort(reverse=True, key=lambda x: x[0])
+        if limit is None:
+            scenarios.sort(reverse=True, key=lambda x: x[0])
+        else:
+            scenarios = heapq.nlargest(limit, scenarios, key=lambda x: x[0])
         return GuidedStorageResponseV2(
                 status=ProbeStatus.DONE,
                 configured=self.model.guided_configuration,
@@ -483,7 +617,7 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         disk = self.model._one(id=disk_id)
         if boot.is_boot_device(disk):
             raise ValueError('device already has bootloader partition')
-        if DeviceAction.TOGGLE_BOOT not in DeviceAction.supported(disk):
+        if DeviceAction.TOGGLE_BOOT not in self._supported_actions(disk):
             raise ValueError("disk does not support boot partiton")
         self.add_boot_disk(disk)
         return await self.v2_GET()
@@ -543,6 +677,29 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         self.partition_disk_handler(disk, spec, partition=partition)
         return await self.v2_GET()
 
+    def _get_block_log_dir_fd(self):
+        # Probes can be triggered by every burst of udev events, so resolve
+        # the log directory once and open the files relative to it.
+        if self._block_log_dir_fd is None:
+            self._block_log_dir_fd = os.open(
+                self.app.block_log_dir, os.O_PATH | os.O_DIRECTORY)
+        return self._block_log_dir_fd
+
+    def _write_probe_data(self, dir_fd, fname, storage):
+        # Pretty printing makes the probe data several times larger and is
+        # only done by the pure Python encoder (as is all encoding straight
+        # to a file with json.dump), so only do it in dry-run mode where a
+        # developer is likely to read the result.
+        if self.app.opts.dry_run:
+            data = json.dumps(storage, indent=4)
+        else:
+            data = json.dumps(storage, separators=(',', ':'))
+        fd = os.open(
+            fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644,
+            dir_fd=dir_fd)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(data)
+
     @with_context(name='probe_once', description='restricted={restricted}')
     async def _probe_once(self, *, context, restricted):
         if restricted:
@@ -563,11 +720,17 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         # https://bugs.launchpad.net/bugs/1954848).
         if self._configured:
             return
-        fpath = os.path.join(self.app.block_log_dir, fname)
-        with open(fpath, 'w') as fp:
-            json.dump(storage, fp, indent=4)
-        self.app.note_file_for_apport(key, fpath)
+        # The probe data can be several megabytes, so serialize and write it
+        # without blocking the event loop.
+        await run_in_thread(
+            self._write_probe_data, self._get_block_log_dir_fd(), fname,
+            storage)
+        if self._configured:
+            return
+        self.app.note_file_for_apport(
+            key, os.path.join(self.app.block_log_dir, fname))
         self.model.load_probe_data(storage)
+        self._bump_gen()
 
     @with_context()
     async def _probe(self, *, context=None):
@@ -640,12 +803,13 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
             self.model.apply_autoinstall_config(self.ai_data['config'])
             self.model.grub = self.ai_data.get('grub')
             self.model.swap = self.ai_data.get('swap')
+            self._bump_gen()
 
     def start(self):
         if self.model.bootloader == Bootloader.PREP:
             self.supports_resilient_boot = False
         else:
-            release = lsb_release(dry_run=self.app.opts.dry_run)['release']
+            release = _release(self.app.opts.dry_run)
             self.supports_resilient_boot = release >= '20.04'
         self._start_task = schedule_task(self._start())
 
@@ -654,6 +818,7 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         self._monitor = pyudev.Monitor.from_netlink(context)
         self._monitor.filter_by(subsystem='block')
         self._monitor.enable_receiving()
+        os.set_blocking(self._monitor.fileno(), False)
         self.start_listening_udev()
         await self._probe_task.start()
 
@@ -665,9 +830,15 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         loop = asyncio.get_event_loop()
         loop.remove_reader(self._monitor.fileno())
 
+    def _udev_queue_settled(self):
+        # This is the check `udevadm settle -t 0` makes, without forking a
+        # process for every event: udevd creates /run/udev/queue while it has
+        # events queued and removes it when the queue is empty.  In dry-run
+        # mode this reflects the host's udev, just as running udevadm did.
+        return not os.path.exists('/run/udev/queue')
+
     def _udev_event(self):
-        cp = run_command(['udevadm', 'settle', '-t', '0'])
-        if cp.returncode != 0:
+        if not self._udev_queue_settled():
             log.debug("waiting 0.1 to let udev event queue settle")
             self.stop_listening_udev()
             loop = asyncio.get_event_loop()
@@ -676,11 +847,18 @@ class FilesystemController(SubiquityController, FilesystemManipulator):
         # Drain the udev events in the queue -- if we stopped listening to
         # allow udev to settle, it's good bet there is more than one event to
         # process and we don't want to kick off a full block probe for each
-        # one.  It's a touch unfortunate that pyudev doesn't have a
-        # non-blocking read so we resort to select().
-        while select.select([self._monitor.fileno()], [], [], 0)[0]:
-            action, dev = self._monitor.receive_device()
-            log.debug("_udev_event %s %s", action, dev)
+        # one.  The events themselves are not interesting (we are about to
+        # reprobe everything) so just read and discard the messages from the
+        # non-blocking socket rather than having pyudev parse each one.
+        count = 0
+        while True:
+            try:
+                if not os.read(self._monitor.fileno(), 65536):
+                    break
+            except BlockingIOError:
+                break
+            count += 1
+        log.debug("_udev_event drained %d events", count)
         try:
             self._probe_task.start_sync()
         except TaskAlreadyRunningError:
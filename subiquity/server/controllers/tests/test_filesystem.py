@@ -13,7 +13,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
 import copy
+import json
+import os
+import tempfile
 from unittest import mock, TestCase, IsolatedAsyncioTestCase
 
 from parameterized import parameterized
@@ -22,6 +26,7 @@ from subiquity.server.controllers.filesystem import FilesystemController
 
 from subiquitycore.tests.mocks import make_app
 from subiquity.common.filesystem import gaps
+from subiquity.common.filesystem.actions import DeviceAction
 from subiquity.common.types import (
     Bootloader,
     GuidedChoiceV2,
@@ -53,6 +58,10 @@ class TestSubiquityControllerFilesystem(IsolatedAsyncioTestCase):
         self.fsc = FilesystemController(app=self.app)
         self.fsc._configured = True
 
+    def _close_block_log_dir_fd(self):
+        if self.fsc._block_log_dir_fd is not None:
+            os.close(self.fsc._block_log_dir_fd)
+
     async def test_probe_restricted(self):
         await self.fsc._probe_once(context=None, restricted=True)
         self.app.prober.get_storage.assert_called_with({'blockdev'})
@@ -70,6 +79,89 @@ class TestSubiquityControllerFilesystem(IsolatedAsyncioTestCase):
         actual = self.app.prober.get_storage.call_args.args[0]
         self.assertTrue({'defaults', 'os'} <= actual)
 
+    @parameterized.expand([(True,), (False,)])
+    async def test_probe_writes_probe_data(self, dry_run):
+        self.app.opts.dry_run = dry_run
+        self.fsc._configured = False
+        storage = {'blockdev': {'/dev/sda': {}}}
+        self.app.prober.get_storage.return_value = storage
+        self.app.note_file_for_apport = mock.Mock()
+        self.addCleanup(self._close_block_log_dir_fd)
+        with tempfile.TemporaryDirectory() as tdir:
+            self.app.block_log_dir = tdir
+            await self.fsc._probe_once(context=None, restricted=True)
+            fpath = os.path.join(tdir, 'probe-data-restricted.json')
+            with open(fpath) as fp:
+                content = fp.read()
+        self.app.note_file_for_apport.assert_called_once_with(
+            'ProbeDataRestricted', fpath)
+        self.assertEqual(storage, json.loads(content))
+        self.assertEqual(dry_run, '\n' in content)
+        self.fsc.model.load_probe_data.assert_called_with(storage)
+
+    async def test_udev_event_drains_queue(self):
+        self.fsc._udev_queue_settled = mock.Mock(return_value=True)
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        os.set_blocking(r, False)
+        os.write(w, b'event')
+        self.fsc._monitor = mock.Mock()
+        self.fsc._monitor.fileno.return_value = r
+        self.fsc._probe_task = mock.Mock()
+        self.fsc._udev_event()
+        with self.assertRaises(BlockingIOError):
+            os.read(r, 1)
+        self.fsc._probe_task.start_sync.assert_called_once_with()
+
+    async def test_udev_event_unsettled(self):
+        self.fsc._udev_queue_settled = mock.Mock(return_value=False)
+        self.fsc._monitor = mock.Mock()
+        self.fsc._probe_task = mock.Mock()
+        with mock.patch('asyncio.get_event_loop') as get_event_loop:
+            self.fsc._udev_event()
+        get_event_loop.return_value.call_later.assert_called_once_with(
+            0.1, self.fsc.start_listening_udev)
+        self.fsc._probe_task.start_sync.assert_not_called()
+
+    @parameterized.expand([
+        (['0', '0'], False),
+        (['0', '1'], True),
+        ([], False),
+        ])
+    async def test_has_rst(self, contents, expected):
+        with tempfile.TemporaryDirectory() as tdir:
+            # Files other than the device links live in the driver dir too.
+            with open(os.path.join(tdir, 'bind'), 'w'):
+                pass
+            os.mkdir(os.path.join(tdir, 'module'))
+            for i, content in enumerate(contents):
+                dev = os.path.join(tdir, f'0000:00:{i:02}.0')
+                os.mkdir(dev)
+                with open(os.path.join(dev, 'remapped_nvme'), 'w') as fp:
+                    fp.write(content)
+            with mock.patch('subiquity.server.controllers.filesystem.'
+                            'AHCI_DRIVER_DIR', tdir):
+                self.assertEqual(expected, await self.fsc.has_rst_GET())
+
+    async def test_has_rst_no_ahci(self):
+        with mock.patch('subiquity.server.controllers.filesystem.'
+                        'AHCI_DRIVER_DIR', '/nonexistent'):
+            self.assertFalse(await self.fsc.has_rst_GET())
+
+    @parameterized.expand([
+        (None, None),
+        ({'blockdev': {'/dev/sda1': {}}}, False),
+        ({'blockdev': {'/dev/sda1': {'ID_FS_TYPE': 'BitLocker'}}}, True),
+        ({'blockdev': {}, 'filesystem': {'/dev/sda1': {'TYPE': 'ntfs'}}},
+         False),
+        ({'blockdev': {}, 'filesystem': {'/dev/sda1': {'TYPE': 'BitLocker'}}},
+         True),
+        ])
+    def test_probe_data_has_bitlocker(self, probe_data, expected):
+        self.fsc.model._probe_data = probe_data
+        self.assertEqual(expected, self.fsc._probe_data_has_bitlocker())
+
 
 class TestGuided(TestCase):
     boot_expectations = [
@@ -129,6 +221,16 @@ class TestGuided(TestCase):
         self.assertEqual(d1p3, part)
         self.assertIsNone(gaps.largest_gap(self.d1))
 
+    def test_guided_lvm_vg_name_taken(self):
+        self._guided_setup(Bootloader.UEFI, 'gpt')
+        self.model.add_volgroup('ubuntu-vg', {make_disk(self.model)})
+        self.model.add_volgroup('ubuntu-vg-1', {make_disk(self.model)})
+        target = GuidedStorageTargetReformat(disk_id=self.d1.id)
+        self.controller.guided(GuidedChoiceV2(target=target, use_lvm=True))
+        [vg] = [vg for vg in self.model.all_volgroups()
+                if self.d1.partitions()[-1] in vg.devices]
+        self.assertEqual('ubuntu-vg-2', vg.name)
+
     def test_guided_lvm_BIOS_MSDOS(self):
         self._guided_setup(Bootloader.BIOS, 'msdos')
         target = GuidedStorageTargetReformat(disk_id=self.d1.id)
@@ -290,6 +392,27 @@ class TestGuidedV2(IsolatedAsyncioTestCase):
         self.assertTrue(isinstance(resize, GuidedStorageTargetResize))
         self.assertEqual(0, len(resp.possible))
 
+    @parameterized.expand(bootloaders_and_ptables)
+    async def test_limit(self, bootloader, ptable):
+        self._setup(bootloader, ptable, size=100 << 30)
+        p = make_partition(self.model, self.disk, preserve=True, size=50 << 30)
+        self.fs_probe[p._path()] = {'ESTIMATED_MIN_SIZE': 1 << 20}
+        full = await self.fsc.v2_guided_GET()
+        limited = await self.fsc.v2_guided_GET(limit=2)
+        self.assertEqual(full.possible[:2], limited.possible)
+
+    @parameterized.expand(bootloaders_and_ptables)
+    async def test_small_disk_not_resized(self, bootloader, ptable):
+        self._setup(bootloader, ptable, size=5 << 30)
+        p = make_partition(self.model, self.disk, preserve=True,
+                           size=4 << 30)
+        self.fs_probe[p._path()] = {'ESTIMATED_MIN_SIZE': 1 << 20}
+        with mock.patch('subiquity.server.controllers.filesystem.sizes.'
+                        'calculate_guided_resize') as calculate:
+            resp = await self.fsc.v2_guided_GET()
+        calculate.assert_not_called()
+        self.assertEqual([], resp.possible)
+
     @parameterized.expand(bootloaders_and_ptables)
     async def test_used_full_disk(self, bootloader, ptable):
         self._setup(bootloader, ptable)
@@ -423,3 +546,83 @@ class TestGuidedV2(IsolatedAsyncioTestCase):
         self.assertFalse(resp.need_root)
         self.assertFalse(resp.need_boot)
         self.assertEqual(0, len(guided_get_resp.possible))
+
+
+class TestRenderCache(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.app = make_app()
+        self.app.opts.bootloader = 'UEFI'
+        self.fsc = FilesystemController(app=self.app)
+        self.fsc.calculate_suggested_install_min = mock.Mock()
+        self.fsc.calculate_suggested_install_min.return_value = 10 << 30
+        self.fsc.model = self.model = make_model(Bootloader.UEFI)
+        self.disk = make_disk(self.model)
+        self.model._probe_data = {'blockdev': {}}
+        self.fsc._probe_task.task = mock.Mock()
+
+    async def test_v2_GET_cached(self):
+        resp1 = await self.fsc.v2_GET()
+        resp2 = await self.fsc.v2_GET()
+        self.assertIs(resp1.disks[0], resp2.disks[0])
+
+    async def test_v2_GET_invalidated_by_change(self):
+        resp1 = await self.fsc.v2_GET()
+        gap = gaps.largest_gap(self.disk)
+        self.fsc.create_partition(self.disk, gap, dict(fstype='ext4'))
+        resp2 = await self.fsc.v2_GET()
+        self.assertIsNot(resp1.disks[0], resp2.disks[0])
+        self.assertEqual(
+            [p.number for p in self.disk.partitions()],
+            [p.number for p in resp2.disks[0].partitions
+             if hasattr(p, 'number')])
+
+    async def test_GET_config_invalidated_by_change(self):
+        part = self.fsc.create_partition(
+            self.disk, gaps.largest_gap(self.disk), dict(fstype='ext4'))
+        resp = await self.fsc.GET()
+        self.assertIn('partition', [a['type'] for a in resp.config])
+        self.fsc.delete_partition(part)
+        resp = await self.fsc.GET()
+        self.assertNotIn('partition', [a['type'] for a in resp.config])
+
+    async def test_config_prerendered_after_change(self):
+        await self.fsc.GET()
+        self.fsc.create_partition(
+            self.disk, gaps.largest_gap(self.disk), dict(fstype='ext4'))
+        self.assertNotIn('config', self.fsc._render_cache)
+        await asyncio.sleep(0)
+        self.assertIn('config', self.fsc._render_cache)
+        with mock.patch.object(self.model, '_render_actions') as render:
+            resp = await self.fsc.GET()
+        render.assert_not_called()
+        self.assertIn('partition', [a['type'] for a in resp.config])
+
+    async def test_config_not_prerendered_unless_requested(self):
+        await self.fsc.v2_GET()
+        self.fsc.create_partition(
+            self.disk, gaps.largest_gap(self.disk), dict(fstype='ext4'))
+        await asyncio.sleep(0)
+        self.assertNotIn('config', self.fsc._render_cache)
+
+    async def test_guided_disks_cached(self):
+        with mock.patch.object(self.fsc, '_compute_guided_disks',
+                               wraps=self.fsc._compute_guided_disks) as m:
+            await self.fsc.v2_guided_GET()
+            await self.fsc.v2_guided_GET()
+            self.assertEqual(3, m.call_count)
+            self.fsc.reformat(self.disk)
+            await self.fsc.v2_guided_GET()
+            self.assertEqual(6, m.call_count)
+
+    def test_get_partition(self):
+        part = self.fsc.create_partition(
+            self.disk, gaps.largest_gap(self.disk), dict(fstype='ext4'))
+        self.assertIs(part, self.fsc.get_partition(self.disk, part.number))
+        self.fsc.delete_partition(part)
+        with self.assertRaises(ValueError):
+            self.fsc.get_partition(self.disk, part.number)
+
+    def test_supported_actions(self):
+        actions = self.fsc._supported_actions(self.disk)
+        self.assertIn(DeviceAction.TOGGLE_BOOT, actions)
+        self.assertIs(actions, self.fsc._supported_actions(self.disk))
@@ -56,14 +56,28 @@ class PasswordEditor(StringEditor):
 
 
 class RestrictedEditor(StringEditor):
-    """Editor that only allows certain characters."""
+    """Editor that only allows certain characters.
+
+    `allowed` is either a frozenset of the allowed characters or a
+    regular expression matching a single allowed character (as a string
+    or already compiled).
+    """
 
     def __init__(self, allowed=None):
         super().__init__()
-        self.matcher = re.compile(allowed)
+        if isinstance(allowed, frozenset):
+            self.allowed_chars = allowed
+            self.matcher = None
+        else:
+            self.allowed_chars = None
+            self.matcher = re.compile(allowed)
 
     def valid_char(self, ch):
-        return len(ch) == 1 and self.matcher.match(ch) is not None
+        if len(ch) != 1:
+            return False
+        if self.matcher is None:
+            return ch in self.allowed_chars
+        return self.matcher.match(ch) is not None
 
 
 RealnameEditor = partial(RestrictedEditor, r'[^:,=]')
@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import logging
 import ipaddress
 
@@ -46,18 +47,50 @@ from subiquitycore.ui.buttons import done_btn
 log = logging.getLogger(
     'subiquitycore.ui.views.network_configure_manual_interface')
 
+# ip_version -> (address class, network class)
 ip_families = {
-    4: {
-        'address_cls': ipaddress.IPv4Address,
-        'network_cls': ipaddress.IPv4Network,
-    },
-    6: {
-        'address_cls': ipaddress.IPv6Address,
-        'network_cls': ipaddress.IPv6Network,
-    }
+    4: (ipaddress.IPv4Address, ipaddress.IPv4Network),
+    6: (ipaddress.IPv6Address, ipaddress.IPv6Network),
 }
 
 
+# The longest textual forms of an address and of a network (address plus
+# "/128", or for IPv4 a "/255.255.255.255" netmask).  Anything longer
+# cannot parse, so reject it without asking ipaddress to pick apart a
+# pasted wall of text.
+_max_address_len = {4: 15, 6: 45}
+_max_network_len = {4: 31, 6: 49}
+_max_prefixlen = {4: 32, 6: 128}
+
+
+# The form cleans every field each time any of them is validated (and
+# clean_address looks at the subnet too), so the same strings get parsed
+# over and over while the user types.  ipaddress objects are immutable so
+# sharing them is fine.
+@functools.lru_cache(maxsize=256)
+def _parse_network(ip_version, s):
+    if len(s) > _max_network_len[ip_version]:
+        raise ValueError(_("too long for an IPv{v} subnet").format(
+            v=ip_version))
+    return ip_families[ip_version][1](s)
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_address(ip_version, s):
+    if len(s) > _max_address_len[ip_version]:
+        raise ValueError(_("too long for an IPv{v} address").format(
+            v=ip_version))
+    return ip_families[ip_version][0](s)
+
+
+_ipv4_chars = frozenset('0123456789.')
+_ipv4_mask_chars = _ipv4_chars | {'/'}
+
+
+def _split_commas(value):
+    return [item for item in map(str.strip, value.split(',')) if item]
+
+
 class IPField(FormField):
     def __init__(self, *args, **kw):
         self.has_mask = kw.pop('has_mask', False)
@@ -68,9 +101,9 @@ class IPField(FormField):
             return StringEditor()
         else:
             if self.has_mask:
-                allowed = '[0-9./]'
+                allowed = _ipv4_mask_chars
             else:
-                allowed = '[0-9.]'
+                allowed = _ipv4_chars
             return RestrictedEditor(allowed)
 
 
@@ -78,10 +111,24 @@ class NetworkConfigForm(Form):
 
     def __init__(self, ip_version, initial={}):
         self.ip_version = ip_version
-        fam = ip_families[ip_version]
-        self.ip_address_cls = fam['address_cls']
-        self.ip_network_cls = fam['network_cls']
-        super().__init__(initial)
+        self.ip_address_cls, self.ip_network_cls = ip_families[ip_version]
+        # Initial values can be passed already parsed.  The widgets want
+        # text, but remember the objects so that cleaning the unchanged
+        # text does not parse it again.
+        self._initial_parsed = {}
+        text_initial = {}
+        for name, value in initial.items():
+            if isinstance(value, (self.ip_address_cls, self.ip_network_cls)):
+                self._initial_parsed[name] = (str(value), value)
+                value = str(value)
+            text_initial[name] = value
+        super().__init__(text_initial)
+
+    def _initial_object(self, name, text):
+        parsed = self._initial_parsed.get(name)
+        if parsed is not None and parsed[0] == text:
+            return parsed[1]
+        return None
 
     ok_label = _("Save")
 
@@ -94,22 +141,39 @@ class NetworkConfigForm(Form):
                                 help=_("Domains, comma separated"))
 
     def clean_subnet(self, subnet):
-        if '/' not in subnet:
+        parsed = self._initial_object('subnet', subnet)
+        if parsed is not None:
+            return parsed
+        address, sep, prefixlen = subnet.partition('/')
+        if not sep or not prefixlen:
             if self.ip_version == 4:
                 example = "xx.xx.xx.xx/yy"
             else:
                 example = "xx:xx:..:xx/yy"
             raise ValueError(_("should be in CIDR form ({example})").format(
                 example=example))
-        return self.ip_network_cls(subnet)
+        # IPv4 also allows a netmask after the '/', which we leave for
+        # ipaddress to check.
+        if prefixlen.isdigit() and int(prefixlen) > _max_prefixlen[
+                self.ip_version]:
+            raise ValueError(
+                _("'{prefixlen}' is not a valid prefix length").format(
+                    prefixlen=prefixlen))
+        return _parse_network(self.ip_version, subnet)
 
     def clean_address(self, address):
-        address = self.ip_address_cls(address)
+        parsed = self._initial_object('address', address)
+        if parsed is None:
+            parsed = _parse_address(self.ip_version, address)
+        address = parsed
         try:
             subnet = self.subnet.value
         except ValueError:
             return
-        if address not in subnet:
+        # Both are the form's family, so skip the type and version checks
+        # `address in subnet` would do.  The subnet comes from the parse
+        # cache, so its netmask is only computed once.
+        if (int(address) & int(subnet.netmask)) != int(subnet.network_address):
             raise ValueError(
                 _("'{address}' is not contained in '{subnet}'").format(
                     address=address, subnet=subnet)
@@ -119,23 +183,19 @@ class NetworkConfigForm(Form):
     def clean_gateway(self, gateway):
         if not gateway:
             return None
-        return self.ip_address_cls(gateway)
+        return _parse_address(self.ip_version, gateway)
 
     def clean_nameservers(self, value):
-        nameservers = []
-        for ns in value.split(','):
-            ns = ns.strip()
-            if ns:
-                nameservers.append(ipaddress.ip_address(ns))
-        return nameservers
+        # Name servers of either family are fine whichever family is being
+        # configured, but only IPv6 addresses contain ':' so there is no
+        # need to let ip_address() try IPv4 and fall back.
+        return [
+            _parse_address(6 if ':' in ns else 4, ns)
+            for ns in _split_commas(value)
+            ]
 
     def clean_searchdomains(self, value):
-        domains = []
-        for domain in value.split(','):
-            domain = domain.strip()
-            if domain:
-                domains.append(domain)
-        return domains
+        return _split_commas(value)
 
 
 network_choices = [
@@ -166,12 +226,13 @@ class EditNetworkStretchy(Stretchy):
         manual_initial = {}
         dhcp_status = getattr(dev_info, 'dhcp' + str(ip_version))
         static_config = getattr(dev_info, 'static' + str(ip_version))
-        if static_config.addresses:
+        addresses = static_config.addresses
+        if addresses:
             method = 'manual'
-            addr = ipaddress.ip_interface(static_config.addresses[0])
+            addr = ipaddress.ip_interface(addresses[0])
             manual_initial = {
-                'subnet': str(addr.network),
-                'address': str(addr.ip),
+                'subnet': addr.network,
+                'address': addr.ip,
                 'nameservers': ', '.join(static_config.nameservers),
                 'searchdomains': ', '.join(static_config.searchdomains),
             }
@@ -188,14 +249,18 @@ class EditNetworkStretchy(Stretchy):
             self.method_form.method.widget, 'select', self._select_method)
 
         log.debug("manual_initial %s", manual_initial)
-        self.manual_form = NetworkConfigForm(ip_version, manual_initial)
+        self._manual_initial = manual_initial
+        self._manual_form = None
 
-        connect_signal(self.method_form, 'submit', self.done)
-        connect_signal(self.manual_form, 'submit', self.done)
-        connect_signal(self.method_form, 'cancel', self.cancel)
-        connect_signal(self.manual_form, 'cancel', self.cancel)
+        self._connect_form(self.method_form)
 
-        self.form_pile = Pile(self.method_form.as_rows())
+        method_rows = self.method_form.as_rows()
+        self.form_pile = Pile(method_rows)
+        self._pack = self.form_pile.options('pack')
+        # The method rows are always shown, so only build them once.
+        self._method_rows = [(row, self._pack) for row in method_rows]
+        self._manual_rows = None
+        self.form_pile.contents[:] = self._method_rows
 
         self.bp = WidgetPlaceholder(self.method_form.buttons)
 
@@ -208,48 +273,66 @@ class EditNetworkStretchy(Stretchy):
             widgets,
             0, 0)
 
-    def _select_method(self, sender, method):
-        rows = []
+    @property
+    def manual_form(self):
+        # Most interfaces use DHCP or are disabled, so only build the
+        # manual form (and parse its initial values) if it is needed.
+        if self._manual_form is None:
+            self._manual_form = NetworkConfigForm(
+                self.ip_version, self._manual_initial)
+            self._connect_form(self._manual_form)
+        return self._manual_form
+
+    def _connect_form(self, form):
+        for signal, handler in (('submit', self.done),
+                                ('cancel', self.cancel)):
+            connect_signal(form, signal, handler)
 
-        def r(w):
-            rows.append((w, self.form_pile.options('pack')))
-        for row in self.method_form.as_rows():
-            r(row)
+    def _select_method(self, sender, method):
+        # The method rows stay put; only add or remove the manual rows
+        # after them.
+        contents = self.form_pile.contents
+        n_method_rows = len(self._method_rows)
         if method == 'manual':
-            r(Text(""))
-            for row in self.manual_form.as_rows():
-                r(row)
+            if self._manual_rows is None:
+                self._manual_rows = [(Text(""), self._pack)]
+                self._manual_rows.extend(
+                    (row, self._pack) for row in self.manual_form.as_rows())
+            if len(contents) == n_method_rows:
+                contents.extend(self._manual_rows)
             self.bp.original_widget = self.manual_form.buttons
         else:
+            del contents[n_method_rows:]
             self.bp.original_widget = self.method_form.buttons
-        self.form_pile.contents[:] = rows
 
     def done(self, sender):
-        if self.method_form.method.value == "manual":
+        method = self.method_form.method.value
+        controller = self.parent.controller
+        if method == "manual":
             form = self.manual_form
-            # XXX this converting from and to and from strings thing is a
-            # bit out of hand.
+            # The form hands back ipaddress objects; StaticConfig is sent
+            # to the server so wants strings.
+            subnet = form.subnet.value
+            address = form.address.value
             gateway = form.gateway.value
             if gateway is not None:
                 gateway = str(gateway)
-            address = str(form.address.value).split('/')[0]
-            address += '/' + str(form.subnet.value).split('/')[1]
             config = StaticConfig(
-                addresses=[address],
+                addresses=['{}/{}'.format(address, subnet.prefixlen)],
                 gateway=gateway,
-                nameservers=list(map(str, form.nameservers.value)),
+                nameservers=[str(ns) for ns in form.nameservers.value],
                 searchdomains=form.searchdomains.value)
             log.debug(
                 "EditNetworkStretchy %s manual config=%s",
                 self.ip_version, config)
-            self.parent.controller.set_static_config(
+            controller.set_static_config(
                 self.dev_info.name, self.ip_version, config)
-        elif self.method_form.method.value == "dhcp":
-            self.parent.controller.enable_dhcp(
+        elif method == "dhcp":
+            controller.enable_dhcp(
                 self.dev_info.name, self.ip_version)
             log.debug("EditNetworkStretchy %s, dhcp", self.ip_version)
         else:
-            self.parent.controller.disable_network(
+            controller.disable_network(
                 self.dev_info.name, self.ip_version)
             log.debug("EditNetworkStretchy %s, disabled", self.ip_version)
         self.parent.remove_overlay()
@@ -1,4 +1,5 @@
 import enum
+import ipaddress
 import typing
 import unittest
 from unittest import mock
@@ -12,6 +13,7 @@ from subiquitycore.models.network import NetDevInfo, StaticConfig
 from subiquitycore.testing import view_helpers
 from subiquitycore.ui.views.network_configure_manual_interface import (
     EditNetworkStretchy,
+    NetworkConfigForm,
     ViewInterfaceInfo,
     )
 from subiquitycore.view import BaseView
@@ -95,6 +97,37 @@ class TestNetworkConfigureIPv4InterfaceView(unittest.TestCase):
         view_helpers.enter_data(stretchy.manual_form, valid_data)
         self.assertTrue(stretchy.manual_form.done_btn.enabled)
 
+    def test_manual_form_lazy(self):
+        dev_info = create_test_instance(
+            NetDevInfo, overrides={'static4.addresses': []})
+        base_view = BaseView(urwid.Text(""))
+        stretchy = EditNetworkStretchy(base_view, dev_info, 4)
+        self.assertIsNone(stretchy._manual_form)
+        stretchy._select_method(None, 'manual')
+        self.assertIsNotNone(stretchy._manual_form)
+
+    def test_select_method(self):
+        _, stretchy = self.make_view()
+        method_rows = [w for w, o in stretchy._method_rows]
+        stretchy._select_method(None, 'dhcp')
+        contents = [w for w, o in stretchy.form_pile.contents]
+        self.assertEqual(method_rows, contents)
+        self.assertIs(
+            stretchy.method_form.buttons, stretchy.bp.original_widget)
+        stretchy._select_method(None, 'manual')
+        contents = [w for w, o in stretchy.form_pile.contents]
+        self.assertEqual(method_rows, contents[:len(method_rows)])
+        self.assertIn(stretchy.manual_form.subnet._table, contents)
+        self.assertIs(
+            stretchy.manual_form.buttons, stretchy.bp.original_widget)
+        stretchy._select_method(None, 'disable')
+        stretchy._select_method(None, 'manual')
+        self.assertEqual(
+            contents, [w for w, o in stretchy.form_pile.contents])
+        stretchy._select_method(None, 'manual')
+        self.assertEqual(
+            contents, [w for w, o in stretchy.form_pile.contents])
+
     def test_click_done(self):
         # The ugliness of this test is probably an indication that the
         # view is doing too much...
@@ -123,6 +156,91 @@ class TestNetworkConfigureIPv4InterfaceView(unittest.TestCase):
             stretchy.dev_info.name, 4, expected)
 
 
+class TestNetworkConfigForm(unittest.TestCase):
+
+    def test_parses_cached(self):
+        form = NetworkConfigForm(4, valid_data)
+        self.assertIs(form.subnet.value, form.subnet.value)
+        self.assertIs(form.address.value, form.address.value)
+
+    def test_parsed_initial(self):
+        subnet = ipaddress.IPv4Network('10.0.2.0/24')
+        address = ipaddress.IPv4Address('10.0.2.15')
+        form = NetworkConfigForm(4, dict(
+            valid_data, subnet=subnet, address=address))
+        self.assertEqual('10.0.2.0/24', form.subnet.widget.value)
+        self.assertIs(subnet, form.subnet.value)
+        self.assertIs(address, form.address.value)
+        form.subnet.widget.value = '10.0.0.0/16'
+        self.assertEqual(
+            ipaddress.IPv4Network('10.0.0.0/16'), form.subnet.value)
+
+    def test_invalid_subnet(self):
+        form = NetworkConfigForm(4, dict(valid_data, subnet='10.0.2.1/24'))
+        with self.assertRaises(ValueError):
+            form.subnet.value
+
+    def test_subnet_prefixlen(self):
+        for subnet in '10.0.2.0', '10.0.2.0/', '10.0.2.0/33', '10.0.2.0/x':
+            form = NetworkConfigForm(4, dict(valid_data, subnet=subnet))
+            with self.assertRaises(ValueError):
+                form.subnet.value
+        form = NetworkConfigForm(
+            4, dict(valid_data, subnet='10.0.2.0/255.255.255.0'))
+        self.assertEqual(
+            ipaddress.IPv4Network('10.0.2.0/24'), form.subnet.value)
+
+    def test_address_not_in_subnet(self):
+        form = NetworkConfigForm(4, dict(valid_data, address='10.0.3.15'))
+        with self.assertRaises(ValueError):
+            form.address.value
+
+    def test_nameservers(self):
+        form = NetworkConfigForm(4, dict(
+            valid_data, nameservers='8.8.8.8, 2001:4860:4860::8888'))
+        self.assertEqual(
+            [ipaddress.IPv4Address('8.8.8.8'),
+             ipaddress.IPv6Address('2001:4860:4860::8888')],
+            form.nameservers.value)
+
+    def test_invalid_nameserver(self):
+        form = NetworkConfigForm(6, dict(valid_data, nameservers='8.8.8'))
+        with self.assertRaises(ValueError):
+            form.nameservers.value
+
+    def test_ipv4_allowed_chars(self):
+        form = NetworkConfigForm(4)
+        self.assertTrue(form.subnet.widget.valid_char('/'))
+        self.assertTrue(form.address.widget.valid_char('1'))
+        self.assertFalse(form.address.widget.valid_char('/'))
+        self.assertFalse(form.address.widget.valid_char('a'))
+
+    def test_too_long(self):
+        form = NetworkConfigForm(4, dict(
+            valid_data, address='10.0.2.15' + '0' * 1000,
+            subnet='10.0.2.0/24' + '0' * 1000))
+        with self.assertRaises(ValueError):
+            form.address.value
+        with self.assertRaises(ValueError):
+            form.subnet.value
+
+    def test_longest_ipv6(self):
+        address = '0000:0000:0000:0000:0000:ffff:255.255.255.255'
+        form = NetworkConfigForm(6, {
+            'subnet': '::/0',
+            'address': address,
+            })
+        self.assertEqual(len(address), 45)
+        self.assertEqual(
+            ipaddress.IPv6Address(address), form.address.value)
+
+    def test_longest_ipv4_netmask(self):
+        subnet = '255.255.255.255/255.255.255.255'
+        form = NetworkConfigForm(4, dict(valid_data, subnet=subnet))
+        self.assertEqual(len(subnet), 31)
+        self.assertEqual(ipaddress.IPv4Network(subnet), form.subnet.value)
+
+
 class FakeLink:
     def serialize(self):
         return "INFO"